@@ -0,0 +1,146 @@
+# analytics.py
+# Consumption anomaly detection: flags bills whose units jump or drop sharply
+# against the customer's own history (meter faults, theft, typos).
+#
+#   python analytics.py            # incremental: rescore customers with new bills
+#   python analytics.py --full     # rescore every customer
+
+import argparse
+import datetime
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from database import DB_PATH, get_conn, init_db, load_bill_frame
+
+# baseline = the customer's previous BASELINE_WINDOW bills
+BASELINE_WINDOW = 12
+MIN_HISTORY = 3
+# modified z-score (Iglewicz & Hoaglin): 0.6745 * (x - median) / MAD
+Z_THRESHOLD = 3.5
+# MAD of a very steady meter can be ~0; floor it so tiny wobbles don't flag
+MAD_FLOOR_FRACTION = 0.05
+MAD_FLOOR_UNITS = 1.0
+SCORING_JOB = "anomaly_scoring"
+
+def load_histories(path: str = DB_PATH, customers_since_id: int = None, max_id: int = None) -> dict:
+    """
+    Load unit histories from the typed bill frame as columnar numpy arrays,
+    sorted by customer then time. With customers_since_id, only customers
+    having a bill with id > it are loaded (their full history, which the
+    baseline needs); max_id ignores bills newer than that id.
+    """
+    df = load_bill_frame(customers_with_bills_after=customers_since_id, max_id=max_id, path=path)
+    codes = df["customer_name"].cat.codes.to_numpy()
+    order = np.lexsort((df["id"].to_numpy(), df["created_at"].to_numpy(), codes))
+    return {
+        "bill_id": df["id"].to_numpy()[order],
+        "bill_no": df["bill_no"].to_numpy()[order],
+        "customer": codes[order],
+        "customer_names": np.asarray(df["customer_name"].cat.categories, dtype=object),
+        "units": df["units"].to_numpy(dtype=float)[order],
+    }
+
+def robust_scores(customer: np.ndarray, units: np.ndarray, window: int = BASELINE_WINDOW,
+                  min_history: int = MIN_HISTORY):
+    """
+    For rows grouped contiguously by customer (in time order), return the
+    rolling baseline median, MAD and modified z-score of each reading against
+    that customer's previous `window` readings. All rows are scored at once
+    through a masked sliding-window view; no per-customer Python loop.
+    Rows with fewer than `min_history` prior readings get NaN.
+    """
+    n = len(units)
+    if n == 0:
+        empty = np.empty(0)
+        return empty, empty, empty
+    # position of each row inside its customer's run
+    starts = np.r_[True, customer[1:] != customer[:-1]]
+    group_start = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+    pos = np.arange(n) - group_start
+
+    # win[i] = units[i - window : i]; blank out slots before the customer's first bill
+    padded = np.concatenate([np.full(window, np.nan), units])
+    win = sliding_window_view(padded, window)[:n]
+    win = np.where(np.arange(window)[None, :] < (window - pos)[:, None], np.nan, win)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN windows
+        baseline = np.nanmedian(win, axis=1)
+        mad = np.nanmedian(np.abs(win - baseline[:, None]), axis=1)
+    scale = np.maximum(mad, np.maximum(MAD_FLOOR_FRACTION * np.abs(baseline), MAD_FLOOR_UNITS))
+    z = 0.6745 * (units - baseline) / scale
+    short = np.minimum(pos, window) < min_history
+    baseline[short] = mad[short] = z[short] = np.nan
+    return baseline, mad, z
+
+def score_consumption(full: bool = False, path: str = DB_PATH, threshold: float = Z_THRESHOLD) -> dict:
+    """
+    Score customers and rewrite their rows in consumption_flags.
+    Incremental runs only rescore customers with bills newer than the last
+    run's watermark (kept in batch_jobs.cursor_id).
+    """
+    init_db(path)
+    conn = get_conn(path)
+    try:
+        state = conn.execute("SELECT cursor_id FROM batch_jobs WHERE job = ?", (SCORING_JOB,)).fetchone()
+        since = None if full or state is None else state["cursor_id"]
+        # fix the watermark first and score only up to it: a bill inserted while
+        # we score is left for the next incremental run instead of being lost
+        watermark = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bills").fetchone()[0]
+        h = load_histories(path, since, watermark)
+        baseline, mad, z = robust_scores(h["customer"], h["units"])
+        flagged = np.flatnonzero(np.abs(np.nan_to_num(z)) >= threshold)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = [
+            (int(h["bill_id"][i]), h["bill_no"][i], h["customer_names"][h["customer"][i]], float(h["units"][i]),
+             round(float(baseline[i]), 2), round(float(mad[i]), 2), round(float(z[i]), 2),
+             "spike" if z[i] > 0 else "drop", now)
+            for i in flagged
+        ]
+        with conn:
+            if since is None:
+                conn.execute("DELETE FROM consumption_flags")
+            else:
+                conn.executemany("DELETE FROM consumption_flags WHERE customer_name = ?",
+                                 [(str(c),) for c in h["customer_names"]])
+            conn.executemany("""
+                INSERT INTO consumption_flags
+                (bill_id, bill_no, customer_name, units, baseline, mad, z_score, direction, scored_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.execute("""
+                INSERT INTO batch_jobs (job, cursor_id, rows_done, status, updated_at) VALUES (?, ?, ?, 'done', ?)
+                ON CONFLICT(job) DO UPDATE SET cursor_id = excluded.cursor_id, rows_done = excluded.rows_done,
+                    status = excluded.status, updated_at = excluded.updated_at
+            """, (SCORING_JOB, watermark, len(h["units"]), datetime.datetime.now().isoformat()))
+    finally:
+        conn.close()
+    return {
+        "mode": "full" if since is None else "incremental",
+        "customers_scored": len(h["customer_names"]),
+        "bills_scored": len(h["units"]),
+        "flagged": len(rows),
+    }
+
+def fetch_consumption_flags(path: str = DB_PATH) -> pd.DataFrame:
+    conn = get_conn(path)
+    try:
+        return pd.read_sql_query("""
+            SELECT f.bill_no, f.customer_name, b.customer_type, f.units, f.baseline, f.mad,
+                   f.z_score, f.direction, b.created_at, f.scored_at
+            FROM consumption_flags f JOIN bills b ON b.id = f.bill_id
+            ORDER BY ABS(f.z_score) DESC
+        """, conn)
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Flag bills with anomalous consumption")
+    parser.add_argument("--full", action="store_true", help="rescore all customers")
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+    print(score_consumption(args.full, args.db))
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,11 @@ import webbrowser
 import threading
 import time
 import os
-from database import init_db, get_user, create_user, save_bill, fetch_bills, backup_db_bytes, restore_db_bytes, update_bill_status
+import functools
+from database import init_db, get_user, create_user, save_bill, load_bill_frame, bill_frame_rupees, data_version, backup_db_bytes, restore_db_bytes, update_bill_status
 from backend import hash_password, verify_password, make_bill
-from utils import generate_bill_pdf_bytes
+from utils import generate_bill_pdf_bytes, page_frame, revenue_series
+from analytics import score_consumption, fetch_consumption_flags
 
 def open_browser():
     time.sleep(3)  # Wait for Streamlit server to start
@@ -34,6 +36,37 @@ if "logged_in" not in st.session_state:
     st.session_state.username = None
     st.session_state.role = None
 
+# ---- Rerun timing (debug mode: BILL_APP_DEBUG=1 or ?debug=1) ----
+DEBUG = os.environ.get("BILL_APP_DEBUG") == "1" or st.query_params.get("debug") == "1"
+TIMING_LOG_SIZE = 30
+RUN_STARTED = time.perf_counter()
+
+def record_timing(name: str, seconds: float):
+    log = st.session_state.setdefault("rerun_timings", [])
+    log.append((datetime.datetime.now().strftime("%H:%M:%S"), name, seconds * 1000))
+    del log[:-TIMING_LOG_SIZE]
+
+def timed_fragment(name: str):
+    """st.fragment that, in debug mode, records and shows how long each run took."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            fn(*args, **kwargs)
+            if DEBUG:
+                elapsed = time.perf_counter() - t0
+                record_timing(name, elapsed)
+                st.caption(f"⏱️ fragment **{name}** ran in {elapsed * 1000:.1f} ms")
+        return st.fragment(wrapper)
+    return decorator
+
+def timing_overlay():
+    # rendered on full reruns; fragment-only reruns show their own caption
+    record_timing("full app rerun", time.perf_counter() - RUN_STARTED)
+    with st.sidebar.expander("⏱️ Rerun timings", expanded=True):
+        log = st.session_state.get("rerun_timings", [])
+        st.dataframe(pd.DataFrame(log[::-1], columns=["At", "Ran", "ms"]).round(1), hide_index=True, use_container_width=True)
+
 # ---- Authentication UI ----
 def login_ui():
     st.title("⚡ Electricity Bill Management System")
@@ -99,8 +132,92 @@ def generate_bill_page():
         st.download_button("⬇️ Download PDF", data=pdf_bytes, file_name=f"{bill['bill_no']}.pdf", mime="application/pdf")
         st.download_button("⬇️ Download CSV", data=pd.DataFrame([bill]).to_csv(index=False).encode(), file_name=f"{bill['bill_no']}.csv")
 
+# ---- Report data (memoized per filter set and data version) ----
+# Cached on the small filter tuple rather than on DataFrames, so a widget
+# rerun inside a fragment is a cache hit instead of a re-query. The key also
+# carries data_version(), which changes on any commit to the database (from
+# this app, service.py, billing-run merges or the surcharge job), so Reports
+# never shows stale data. The frame is a shared resource (not copied per hit)
+# and must be treated as read-only.
+REPORT_CACHE_TTL = 300
+REPORT_CACHE_ENTRIES = 16
+
+@st.cache_resource(ttl=REPORT_CACHE_TTL, max_entries=REPORT_CACHE_ENTRIES, show_spinner=False)
+def report_frame(filters: tuple, version: tuple) -> pd.DataFrame:
+    # typed bill frame: categoricals, datetime64 created_at, integer-paise money
+    date_from, date_to, cust_type, status = filters
+    return load_bill_frame(date_from=date_from, date_to=date_to, customer_type=cust_type, status=status)
+
+@st.cache_data(ttl=REPORT_CACHE_TTL, max_entries=REPORT_CACHE_ENTRIES, show_spinner=False)
+def report_summary(filters: tuple, version: tuple) -> dict:
+    df = report_frame(filters, version)
+    return {
+        "total_bills": len(df),
+        "total_revenue": df['total_paise'].sum() / 100,
+        "avg_units": df['units'].mean(),
+        "by_type": df.groupby('customer_type', observed=True)['total_paise'].sum().rename('total') / 100,
+        # bucket size (day/week/month) follows the range; LTTB keeps the point count bounded
+        "revenue": revenue_series(df['created_at'], (df['total_paise'] / 100).rename('total')),
+    }
+
+@st.cache_data(ttl=REPORT_CACHE_TTL, max_entries=REPORT_CACHE_ENTRIES, show_spinner=False)
+def report_csv(filters: tuple, version: tuple) -> bytes:
+    return bill_frame_rupees(report_frame(filters, version)).to_csv(index=False).encode()
+
+@st.cache_data(ttl=REPORT_CACHE_TTL, max_entries=REPORT_CACHE_ENTRIES, show_spinner=False)
+def report_bill_numbers(filters: tuple, version: tuple) -> list:
+    return report_frame(filters, version)['bill_no'].tolist()
+
+# ---- Reports fragments: each reruns on its own widget changes ----
+@timed_fragment("Reports grid")
+def report_grid(filters: tuple):
+    df = report_frame(filters, data_version())
+    # server-side paging: only the visible window of rows is sent to the browser
+    p1, p2, p3 = st.columns([1,1,2])
+    page_size = p1.selectbox("Rows per page", [25,50,100,250], index=1)
+    n_pages = max((len(df) - 1) // page_size + 1, 1)
+    page = p2.number_input("Page", min_value=1, max_value=n_pages, value=1, step=1)
+    start = (page - 1) * page_size
+    p3.caption(f"Rows {start + 1}–{min(start + page_size, len(df))} of {len(df)}")
+    st.dataframe(bill_frame_rupees(page_frame(df, page, page_size))[['bill_no','customer_name','customer_type','units','energy_charge','fixed_charge','gst','total','status','created_at']].rename(columns={
+        'bill_no':'Bill No','customer_name':'Customer','customer_type':'Type','units':'Units','energy_charge':'Energy','fixed_charge':'Fixed','gst':'GST','total':'Total','created_at':'Date'
+    }), use_container_width=True)
+
+@timed_fragment("Reports charts")
+def report_charts(filters: tuple):
+    summary = report_summary(filters, data_version())
+    st.metric("Total Bills", summary["total_bills"])
+    st.metric("Total Revenue (₹)", f"{summary['total_revenue']:.2f}")
+    st.metric("Average Units", f"{summary['avg_units']:.2f}")
+
+    # simple charts
+    st.subheader("Revenue by Type")
+    st.bar_chart(summary["by_type"])
+
+    revenue = summary["revenue"]
+    st.subheader(f"Revenue per {revenue.index.name.title()}")
+    st.line_chart(revenue)
+
+@timed_fragment("Reports export")
+def report_export(filters: tuple):
+    date_from, date_to = filters[:2]
+    st.download_button("⬇️ Download Report (CSV)", data=report_csv(filters, data_version()), file_name=f"report_{date_from}_{date_to}.csv", mime="text/csv")
+
+@timed_fragment("Admin status tools")
+def report_admin_tools(filters: tuple):
+    st.markdown("---")
+    st.subheader("Admin Tools — Update Bill Status")
+    sel = st.selectbox("Select Bill No", report_bill_numbers(filters, data_version()))
+    new_status = st.selectbox("Set Status To", ["Paid","Unpaid"])
+    if st.button("Update Status"):
+        update_bill_status(sel, new_status)
+        st.session_state.flash = f"Status of {sel} set to {new_status}."
+        st.rerun()  # full rerun so the grid, charts and export pick up the change
+
 def reports_page():
     st.header("📊 Reports & Analytics")
+    if st.session_state.get("flash"):
+        st.success(st.session_state.pop("flash"))
     c1, c2, c3, c4 = st.columns([1.5,1.5,1,1])
     with c1:
         cust_type = st.selectbox("Customer Type", ["All","Domestic","Commercial"])
@@ -111,45 +228,39 @@ def reports_page():
     with c4:
         status = st.selectbox("Status", ["All","Unpaid","Paid"])
 
-    df = fetch_bills(date_from=date_from.strftime("%Y-%m-%d"), date_to=date_to.strftime("%Y-%m-%d"), customer_type=cust_type, status=status)
-    if df.empty:
+    filters = (date_from.strftime("%Y-%m-%d"), date_to.strftime("%Y-%m-%d"), cust_type, status)
+    if report_frame(filters, data_version()).empty:
         st.info("No bills found for selected filters.")
         return
 
-    df["created_at"] = pd.to_datetime(df["created_at"])
-    st.dataframe(df[['bill_no','customer_name','customer_type','units','energy_charge','fixed_charge','gst','total','status','created_at']].rename(columns={
-        'bill_no':'Bill No','customer_name':'Customer','customer_type':'Type','units':'Units','energy_charge':'Energy','fixed_charge':'Fixed','gst':'GST','total':'Total','created_at':'Date'
-    }), use_container_width=True)
-
-    total_revenue = df['total'].sum()
-    total_bills = len(df)
-    avg_units = df['units'].mean()
-
-    st.metric("Total Bills", total_bills)
-    st.metric("Total Revenue (₹)", f"{total_revenue:.2f}")
-    st.metric("Average Units", f"{avg_units:.2f}")
-
-    # simple charts
-    st.subheader("Revenue by Type")
-    by_type = df.groupby('customer_type')['total'].sum().reset_index()
-    st.bar_chart(by_type.set_index('customer_type'))
-
-    st.subheader("Daily Revenue")
-    daily = df.groupby(df['created_at'].dt.date)['total'].sum()
-    st.line_chart(daily)
-
-    # Export
-    st.download_button("⬇️ Download Report (CSV)", data=df.to_csv(index=False).encode(), file_name=f"report_{date_from}_{date_to}.csv", mime="text/csv")
+    report_grid(filters)
+    report_charts(filters)
+    report_export(filters)
 
     # quick status update (admin only)
     if st.session_state.role == "admin":
-        st.markdown("---")
-        st.subheader("Admin Tools — Update Bill Status")
-        sel = st.selectbox("Select Bill No", df['bill_no'].tolist())
-        new_status = st.selectbox("Set Status To", ["Paid","Unpaid"])
-        if st.button("Update Status"):
-            update_bill_status(sel, new_status)
-            st.success("Status updated. Refresh to see changes.")
+        report_admin_tools(filters)
+
+@timed_fragment("Anomaly review")
+def anomaly_review():
+    st.subheader("Consumption Anomalies")
+    st.caption("Bills whose units deviate sharply from the customer's own recent history (robust z-score).")
+    a1, a2 = st.columns(2)
+    if a1.button("Rescore new bills"):
+        res = score_consumption()
+        st.success(f"Rescored {res['customers_scored']} customers; {res['flagged']} bills flagged.")
+    if a2.button("Full rescore"):
+        res = score_consumption(full=True)
+        st.success(f"Rescored {res['customers_scored']} customers; {res['flagged']} bills flagged.")
+    flags = fetch_consumption_flags()
+    if flags.empty:
+        st.info("No flagged bills. Run a rescore to check new bills.")
+    else:
+        st.dataframe(flags.head(500).rename(columns={
+            'bill_no':'Bill No','customer_name':'Customer','customer_type':'Type','units':'Units','baseline':'Baseline',
+            'mad':'MAD','z_score':'Z','direction':'Direction','created_at':'Date','scored_at':'Scored'
+        }), use_container_width=True)
+        st.caption(f"{len(flags)} flagged bills (showing top 500 by |Z|).")
 
 def admin_panel():
     st.header("🛠️ Admin Panel")
@@ -167,6 +278,9 @@ def admin_panel():
             create_user(username, hash_password(password), role)
             st.success("User created.")
 
+    st.markdown("---")
+    anomaly_review()
+
     st.markdown("---")
     st.subheader("Database Backup / Restore")
     if st.button("🔽 Download DB Backup"):
@@ -208,3 +322,6 @@ else:
         admin_panel()
     elif choice == "Logout":
         logout()
+
+    if DEBUG:
+        timing_overlay()
@@ -2,9 +2,12 @@
 # Hashing, bill calculation, helpers
 
 import hashlib
+import itertools
+import os
 import random
 import datetime
-from typing import Tuple, Union, Dict
+import numpy as np
+from typing import Tuple, Union, Dict, List, Sequence
 
 def hash_password(password: str) -> str:
     """Return SHA-256 hex digest for password (simple, no extra packages)."""
@@ -49,9 +52,59 @@ def calculate_bill(units: float, customer_type: str) -> Union[Tuple[float,float,
     # Round
     return round(energy,2), round(fixed,2), round(gst,2), round(total,2)
 
+# per-type tariff: (base slab rate, fixed charge, max units per month)
+TARIFFS = {
+    "domestic": (1.5, 50.0, 10000),
+    "commercial": (3.5, 100.0, 50000),
+}
+
+def calculate_bills(units: Sequence[float], customer_types: Sequence[str]) -> Dict[str, np.ndarray]:
+    """
+    Vectorized calculate_bill over many readings at once.
+    Returns arrays energy_charge, fixed_charge, gst, total and a boolean
+    `valid` mask (False where units exceed the permissible range).
+    """
+    u = np.nan_to_num(np.asarray(units, dtype=float))
+    is_dom = np.array([str(t).lower() == "domestic" for t in customer_types], dtype=bool)
+    dom_rate, dom_fixed, dom_max = TARIFFS["domestic"]
+    com_rate, com_fixed, com_max = TARIFFS["commercial"]
+    base = np.where(is_dom, dom_rate, com_rate)
+    fixed = np.where(is_dom, dom_fixed, com_fixed)
+    valid = u <= np.where(is_dom, dom_max, com_max)
+
+    # closed form of the slab loop: f full 100-unit slabs plus a remainder
+    # billed at the (f+1)th slab rate; each slab adds 0.5 to the rate
+    pos = np.maximum(u, 0.0)
+    full = np.floor(pos / 100)
+    rem = pos - full * 100
+    energy = 100 * (full * base + 0.25 * full * (full - 1)) + rem * (base + 0.5 * full)
+    gst = energy * 0.18
+    total = energy + fixed + gst
+    return {
+        "energy_charge": _round2(energy),
+        "fixed_charge": _round2(fixed),
+        "gst": _round2(gst),
+        "total": _round2(total),
+        "valid": valid,
+    }
+
+def _round2(values: np.ndarray) -> np.ndarray:
+    # np.round scales by 100 first and disagrees with round() on some half-paise
+    # values; round through Python floats so results match calculate_bill exactly
+    return np.array([round(v, 2) for v in values.tolist()], dtype=float)
+
 def new_bill_number() -> str:
     return f"BILL{random.randint(10000, 99999)}"
 
+# sequenced bill numbers for bulk creation: module load time + pid scope the
+# counter to one process, so numbers never repeat within or across processes
+_BILL_SEQ = itertools.count(1)
+_BILL_SEQ_STARTED = datetime.datetime.now().strftime("%y%m%d%H%M%S")
+
+def next_bill_number() -> str:
+    """Collision-free bill number, e.g. BILL251019100502P4123-0000001."""
+    return f"BILL{_BILL_SEQ_STARTED}P{os.getpid()}-{next(_BILL_SEQ):07d}"
+
 def make_bill(customer_name: str, customer_type: str, units: float, status: str = "Unpaid") -> Union[dict, Dict[str, str]]:
     result = calculate_bill(units, customer_type)
     if isinstance(result, dict) and "error" in result:
@@ -71,3 +124,35 @@ def make_bill(customer_name: str, customer_type: str, units: float, status: str
         "status": status,
         "created_at": now
     }
+
+def make_bills(rows: Sequence[dict], status: str = "Unpaid") -> List[dict]:
+    """
+    Bulk make_bill: prices every row in one calculate_bills call.
+    Each row needs customer_name, customer_type, units (and optionally status).
+    Returns one bill dict per row, or an error dict for rows out of range.
+    Bill numbers come from next_bill_number, so a bulk call never repeats one.
+    """
+    if not rows:
+        return []
+    units = [float(r.get("units") or 0.0) for r in rows]
+    priced = calculate_bills(units, [r["customer_type"] for r in rows])
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    bills = []
+    for i, r in enumerate(rows):
+        if not priced["valid"][i]:
+            kind = "domestic" if r["customer_type"].lower() == "domestic" else "commercial"
+            bills.append({"error": f"Unit value exceeds permissible usage range for {kind}. Please recheck input."})
+            continue
+        bills.append({
+            "bill_no": next_bill_number(),
+            "customer_name": r["customer_name"],
+            "customer_type": r["customer_type"],
+            "units": r["units"],
+            "energy_charge": float(priced["energy_charge"][i]),
+            "fixed_charge": float(priced["fixed_charge"][i]),
+            "gst": float(priced["gst"][i]),
+            "total": float(priced["total"][i]),
+            "status": r.get("status", status),
+            "created_at": now
+        })
+    return bills
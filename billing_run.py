@@ -0,0 +1,302 @@
+# billing_run.py
+# Sharded month-end billing runs: price (and optionally render) meter readings
+# on independent workers, then merge the shard outputs into the bills table.
+#
+# Input is a CSV of readings with columns customer_name, customer_type, units
+# (optional: status). Readings are split by a stable hash of customer_name, so
+# every worker/machine given the same file and shard count picks the same rows.
+#
+#   python billing_run.py worker --input readings.csv --run-id 2025-11 --run-date 2025-11-30 --shard 0 --shards 4
+#   python billing_run.py merge  --run-id 2025-11 --shards 4
+#   python billing_run.py local  --input readings.csv --run-id 2025-11 --run-date 2025-11-30 --shards 4 --workers 4
+
+import argparse
+import datetime
+import hashlib
+import heapq
+import os
+import re
+import sqlite3
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from database import DB_PATH, BILL_STATUSES, CUSTOMER_TYPES, get_conn, init_db, BILL_INSERT_SQL
+from backend import calculate_bills
+from utils import generate_bill_pdf_bytes
+
+SHARD_DIR = "billing_shards"
+REQUIRED_COLUMNS = ("customer_name", "customer_type", "units")
+
+SHARD_SCHEMA = """
+CREATE TABLE shard_meta (
+    run_id TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    shards INTEGER NOT NULL,
+    input_sha256 TEXT NOT NULL,
+    input_rows INTEGER NOT NULL,
+    bills INTEGER NOT NULL,
+    rejected INTEGER NOT NULL,
+    revenue_paise INTEGER NOT NULL,
+    created_at TEXT
+);
+CREATE TABLE shard_bills (
+    source_row INTEGER PRIMARY KEY,
+    bill_no TEXT NOT NULL,
+    customer_name TEXT NOT NULL,
+    customer_type TEXT NOT NULL,
+    units REAL,
+    energy_charge REAL,
+    fixed_charge REAL,
+    gst REAL,
+    total REAL,
+    total_paise INTEGER NOT NULL,
+    status TEXT,
+    created_at TEXT
+);
+CREATE TABLE shard_rejects (
+    source_row INTEGER PRIMARY KEY,
+    customer_name TEXT,
+    customer_type TEXT,
+    units REAL,
+    error TEXT
+);
+CREATE TABLE shard_pdfs (
+    bill_no TEXT PRIMARY KEY,
+    pdf BLOB NOT NULL
+);
+"""
+
+def _run_tag(run_id: str) -> str:
+    if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9_-]*", run_id):
+        raise ValueError("run_id may only contain letters, digits, '-' and '_'")
+    return re.sub(r"[^A-Za-z0-9]", "", run_id)
+
+def bill_number(run_id: str, source_row: int) -> str:
+    """Deterministic, run-scoped bill number; never collides with random BILLnnnnn numbers."""
+    return f"BILL{_run_tag(run_id)}-{source_row + 1:07d}"
+
+def shard_of(customer_names: pd.Series, shards: int) -> np.ndarray:
+    """Stable (process- and machine-independent) shard index per customer."""
+    return np.fromiter((zlib.crc32(str(n).encode("utf-8")) % shards for n in customer_names),
+                       dtype=np.int64, count=len(customer_names))
+
+def shard_path(out_dir: str, run_id: str, shard: int, shards: int) -> str:
+    return os.path.join(out_dir, f"{run_id}_shard{shard:03d}_of{shards:03d}.db")
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _to_paise(values) -> np.ndarray:
+    return np.rint(np.asarray(values, dtype=float) * 100).astype(np.int64)
+
+# -------- Worker ----------
+def run_worker(input_path: str, run_id: str, run_date: str, shard: int, shards: int,
+               out_dir: str = SHARD_DIR, render: bool = False) -> str:
+    """
+    Price this worker's shard of the readings and write it to a self-contained
+    SQLite file (bills, rejects, optional PDFs and a meta row with counts and
+    revenue for the merge to verify). Returns the shard file path.
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f"shard must be in [0, {shards})")
+    datetime.date.fromisoformat(run_date)
+    created_at = f"{run_date} 00:00:00"
+    digest = file_sha256(input_path)
+    df = pd.read_csv(input_path, dtype={"customer_name": str, "customer_type": str})
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"input is missing columns: {', '.join(missing)}")
+    input_rows = len(df)
+    df["source_row"] = np.arange(input_rows)
+    if "status" not in df.columns:
+        df["status"] = "Unpaid"
+    df["status"] = df["status"].fillna("Unpaid")
+    # unreadable units stay NaN and are rejected below, never billed as 0 units
+    df["units"] = pd.to_numeric(df["units"], errors="coerce")
+    part = df[shard_of(df["customer_name"], shards) == shard]
+
+    units = part["units"].to_numpy(dtype=float)
+    named = (part["customer_name"].fillna("").str.strip() != "").to_numpy()
+    known_type = part["customer_type"].isin(CUSTOMER_TYPES).to_numpy()
+    known_status = part["status"].isin(BILL_STATUSES).to_numpy()
+    readable = np.isfinite(units) & (units >= 0)
+    priced = calculate_bills(np.where(readable, units, 0.0), part["customer_type"].tolist())
+    valid = named & known_type & known_status & readable & priced["valid"]
+    bills = part[valid].copy()
+    for col in ("energy_charge", "fixed_charge", "gst", "total"):
+        bills[col] = priced[col][valid]
+    bills["total_paise"] = _to_paise(bills["total"])
+    bills["bill_no"] = [bill_number(run_id, r) for r in bills["source_row"]]
+    bills["created_at"] = created_at
+    rejects = part[~valid].copy()
+    # first failed check wins
+    rejects["error"] = np.select(
+        [~named[~valid], ~known_type[~valid], ~known_status[~valid], ~readable[~valid]],
+        ["Customer name is missing. Please recheck input.",
+         f"Unknown customer type. Expected one of {', '.join(CUSTOMER_TYPES)}.",
+         f"Unknown status. Expected one of {', '.join(BILL_STATUSES)}.",
+         "Units are missing or not a non-negative number. Please recheck input."],
+        [f"Unit value exceeds permissible usage range for {t.lower()}. Please recheck input."
+         for t in rejects["customer_type"].fillna("")]
+    ).tolist()
+
+    os.makedirs(out_dir, exist_ok=True)
+    final = shard_path(out_dir, run_id, shard, shards)
+    tmp = final + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(SHARD_SCHEMA)
+        with conn:
+            bill_cols = ["source_row", "bill_no", "customer_name", "customer_type", "units", "energy_charge",
+                         "fixed_charge", "gst", "total", "total_paise", "status", "created_at"]
+            conn.executemany(
+                f"INSERT INTO shard_bills ({', '.join(bill_cols)}) VALUES ({', '.join('?' * len(bill_cols))})",
+                bills[bill_cols].itertuples(index=False, name=None)
+            )
+            conn.executemany(
+                "INSERT INTO shard_rejects (source_row, customer_name, customer_type, units, error) VALUES (?, ?, ?, ?, ?)",
+                rejects[["source_row", "customer_name", "customer_type", "units", "error"]].itertuples(index=False, name=None)
+            )
+            if render:
+                for bill in bills.drop(columns=["source_row", "total_paise"]).to_dict(orient="records"):
+                    conn.execute("INSERT INTO shard_pdfs (bill_no, pdf) VALUES (?, ?)",
+                                 (bill["bill_no"], generate_bill_pdf_bytes(bill)))
+            conn.execute(
+                "INSERT INTO shard_meta VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, run_date, shard, shards, digest, input_rows, len(bills), len(rejects),
+                 int(bills["total_paise"].sum()), datetime.datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+    # only a complete shard file ever appears under the final name
+    os.replace(tmp, final)
+    return final
+
+# -------- Merge ----------
+def _read_meta(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        meta = dict(conn.execute("SELECT * FROM shard_meta").fetchone())
+        bills, paise = conn.execute("SELECT COUNT(*), COALESCE(SUM(total_paise), 0) FROM shard_bills").fetchone()
+        rejected = conn.execute("SELECT COUNT(*) FROM shard_rejects").fetchone()[0]
+    finally:
+        conn.close()
+    if (bills, rejected, paise) != (meta["bills"], meta["rejected"], meta["revenue_paise"]):
+        raise ValueError(f"{path}: contents do not match its meta row (bills/rejects/revenue)")
+    return meta
+
+def _shard_rows(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        yield from conn.execute("""
+            SELECT source_row, bill_no, customer_name, customer_type, units, energy_charge,
+                   fixed_charge, gst, total, status, created_at
+            FROM shard_bills ORDER BY source_row
+        """)
+    finally:
+        conn.close()
+
+def merge_run(run_id: str, shards: int, out_dir: str = SHARD_DIR, path: str = DB_PATH) -> dict:
+    """
+    Verify all shard outputs of a run and insert their bills into the bills
+    table in one transaction, in input order (so ids and results do not depend
+    on the shard count). Refuses to merge the same run twice.
+    """
+    paths = [shard_path(out_dir, run_id, i, shards) for i in range(shards)]
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f"missing shard outputs: {', '.join(missing)}")
+    metas = [_read_meta(p) for p in paths]
+    for i, m in enumerate(metas):
+        if (m["run_id"], m["shard"], m["shards"]) != (run_id, i, shards):
+            raise ValueError(f"{paths[i]}: belongs to run {m['run_id']} shard {m['shard']}/{m['shards']}")
+    first = metas[0]
+    if any((m["input_sha256"], m["run_date"]) != (first["input_sha256"], first["run_date"]) for m in metas):
+        raise ValueError("shards were produced from different inputs or run dates")
+    expected_bills = sum(m["bills"] for m in metas)
+    rejected = sum(m["rejected"] for m in metas)
+    expected_paise = sum(m["revenue_paise"] for m in metas)
+    if expected_bills + rejected != first["input_rows"]:
+        raise ValueError(f"shards cover {expected_bills + rejected} readings but the input has {first['input_rows']}")
+
+    init_db(path)
+    conn = get_conn(path)
+    try:
+        with conn:
+            # take the write lock first: the checks, the id watermark and the
+            # inserts must not interleave with another writer's commit
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM billing_runs WHERE run_id = ?", (run_id,)).fetchone():
+                raise ValueError(f"run {run_id} has already been merged")
+            if conn.execute("SELECT 1 FROM bills WHERE bill_no LIKE ? LIMIT 1", (f"BILL{_run_tag(run_id)}-%",)).fetchone():
+                raise ValueError(f"bills numbered for run {run_id} already exist")
+            before = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bills").fetchone()[0]
+            # k-way merge of the shard streams by source_row
+            merged = heapq.merge(*(_shard_rows(p) for p in paths), key=lambda r: r[0])
+            conn.executemany(BILL_INSERT_SQL, (row[1:] for row in merged))
+            n, paise = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(CAST(ROUND(total * 100) AS INTEGER)), 0) FROM bills WHERE id > ?",
+                (before,)
+            ).fetchone()
+            if (n, paise) != (expected_bills, expected_paise):
+                raise ValueError(f"verification failed: inserted {n} bills / {paise} paise, "
+                                 f"expected {expected_bills} / {expected_paise}")
+            conn.execute(
+                "INSERT INTO billing_runs (run_id, shards, input_sha256, bills, rejected, revenue_paise, merged_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (run_id, shards, first["input_sha256"], n, rejected, paise, datetime.datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+    return {"run_id": run_id, "shards": shards, "bills": n, "rejected": rejected,
+            "revenue": paise / 100, "input_sha256": first["input_sha256"]}
+
+def run_local(input_path: str, run_id: str, run_date: str, shards: int, workers: int = None,
+              out_dir: str = SHARD_DIR, render: bool = False, path: str = DB_PATH) -> dict:
+    """Run every shard in local worker processes, then merge."""
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(run_worker, input_path, run_id, run_date, i, shards, out_dir, render)
+                   for i in range(shards)]
+        for f in futures:
+            f.result()
+    return merge_run(run_id, shards, out_dir, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded billing runs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("worker", "merge", "local"):
+        p = sub.add_parser(name)
+        p.add_argument("--run-id", required=True)
+        p.add_argument("--shards", type=int, required=True)
+        p.add_argument("--out-dir", default=SHARD_DIR)
+        if name in ("worker", "local"):
+            p.add_argument("--input", required=True)
+            p.add_argument("--run-date", required=True, help="YYYY-MM-DD, used as every bill's created_at")
+            p.add_argument("--render", action="store_true", help="also store each bill's PDF in the shard file")
+        if name == "worker":
+            p.add_argument("--shard", type=int, required=True)
+        if name in ("merge", "local"):
+            p.add_argument("--db", default=DB_PATH)
+        if name == "local":
+            p.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        print(run_worker(args.input, args.run_id, args.run_date, args.shard, args.shards, args.out_dir, args.render))
+    elif args.command == "merge":
+        print(merge_run(args.run_id, args.shards, args.out_dir, args.db))
+    else:
+        print(run_local(args.input, args.run_id, args.run_date, args.shards, args.workers,
+                        args.out_dir, args.render, args.db))
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,31 @@
 # database.py
 # SQLite helpers: init DB, user management, bills CRUD, backup/restore
 
+import os
 import sqlite3
 import datetime
+import queue
+import threading
+import warnings
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from concurrent.futures import Future
 from typing import Optional
 
 DB_PATH = "electricity_bills.db"
 
+# Group-commit setting for save_bill: the writer thread commits whatever is
+# queued (up to this many rows) as soon as the previous commit finishes.
+WRITE_BATCH_MAX_ROWS = 256
+
 def get_conn(path: str = DB_PATH):
     conn = sqlite3.connect(path, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_conn()
+def init_db(path: str = DB_PATH):
+    conn = get_conn(path)
     cur = conn.cursor()
 
     # users table: store hashed passwords
@@ -45,12 +56,96 @@ def init_db():
     )
     """)
 
+    # late-payment surcharge: per-bill surcharge column (folded into total),
+    # one surcharge record per bill, and a cursor table for resumable batch jobs
+    cols = [r["name"] for r in cur.execute("PRAGMA table_info(bills)")]
+    if "surcharge" not in cols:
+        cur.execute("ALTER TABLE bills ADD COLUMN surcharge REAL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bills_status_created ON bills (status, created_at)")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_bills_unsurcharged ON bills (created_at)
+    WHERE status = 'Unpaid' AND COALESCE(surcharge, 0) = 0
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS bill_surcharges (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bill_id INTEGER UNIQUE NOT NULL REFERENCES bills(id),
+        bill_no TEXT NOT NULL,
+        due_date TEXT NOT NULL,
+        days_overdue INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        job TEXT NOT NULL,
+        created_at TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS batch_jobs (
+        job TEXT PRIMARY KEY,
+        cursor_created_at TEXT,
+        cursor_id INTEGER,
+        rows_done INTEGER DEFAULT 0,
+        status TEXT,
+        updated_at TEXT
+    )
+    """)
+
+    # consumption anomaly flags (written by analytics.py)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bills_customer_created ON bills (customer_name, created_at)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS consumption_flags (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bill_id INTEGER UNIQUE NOT NULL REFERENCES bills(id),
+        bill_no TEXT NOT NULL,
+        customer_name TEXT NOT NULL,
+        units REAL,
+        baseline REAL,
+        mad REAL,
+        z_score REAL,
+        direction TEXT,
+        scored_at TEXT
+    )
+    """)
+
+    # bill dispatch: customer e-mail addresses and a per-bill delivery ledger
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS customer_contacts (
+        customer_name TEXT PRIMARY KEY,
+        email TEXT NOT NULL,
+        updated_at TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS bill_deliveries (
+        bill_id INTEGER PRIMARY KEY REFERENCES bills(id),
+        bill_no TEXT NOT NULL,
+        recipient TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        last_error TEXT,
+        sent_at TEXT,
+        updated_at TEXT
+    )
+    """)
+
+    # sharded billing runs merged by billing_run.py (one row per merged run)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS billing_runs (
+        run_id TEXT PRIMARY KEY,
+        shards INTEGER NOT NULL,
+        input_sha256 TEXT NOT NULL,
+        bills INTEGER NOT NULL,
+        rejected INTEGER NOT NULL,
+        revenue_paise INTEGER NOT NULL,
+        merged_at TEXT
+    )
+    """)
+
     # ensure admin exists: default password is '1234' (hashed externally)
     # Admin creation will be handled from app on first run (or create here if needed)
     conn.commit()
     conn.close()
 
-# -------- Users ----------
+# -------- Users / Customers ----------
 def create_user(username: str, password_hash: str, role: str = "user"):
     conn = get_conn()
     cur = conn.cursor()
@@ -69,15 +164,25 @@ def get_user(username: str) -> Optional[sqlite3.Row]:
     conn.close()
     return row
 
-# -------- Bills ----------
-def save_bill(bill: dict):
-    conn = get_conn()
+def set_customer_email(customer_name: str, email: str, path: str = DB_PATH):
+    conn = get_conn(path)
     cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO bills
-        (bill_no, customer_name, customer_type, units, energy_charge, fixed_charge, gst, total, status, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    cur.execute(
+        "INSERT OR REPLACE INTO customer_contacts (customer_name, email, updated_at) VALUES (?, ?, ?)",
+        (customer_name, email, datetime.datetime.now().isoformat())
+    )
+    conn.commit()
+    conn.close()
+
+# -------- Bills ----------
+BILL_INSERT_SQL = """
+    INSERT INTO bills
+    (bill_no, customer_name, customer_type, units, energy_charge, fixed_charge, gst, total, status, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _bill_params(bill: dict) -> tuple:
+    return (
         bill["bill_no"],
         bill["customer_name"],
         bill["customer_type"],
@@ -88,16 +193,123 @@ def save_bill(bill: dict):
         bill["total"],
         bill.get("status", "Unpaid"),
         bill["created_at"]
-    ))
-    conn.commit()
-    conn.close()
+    )
+
+class BillWriter:
+    """
+    Single writer thread that coalesces bill inserts from every session into
+    one transaction (group commit). It never waits for more rows: it takes
+    whatever queued while the previous commit ran, commits it, and repeats,
+    so a lone caller pays one commit and concurrent callers share commits.
+    Callers get a Future that resolves once their row has been committed.
+    """
+
+    def __init__(self, max_rows: int = WRITE_BATCH_MAX_ROWS, path: str = DB_PATH):
+        self.max_rows = max_rows
+        self.path = path
+        self._conn = None
+        self._reopen = threading.Event()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="bill-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, bill: dict) -> Future:
+        fut = Future()
+        # build params up front so a malformed bill fails in the caller's thread
+        self._queue.put((_bill_params(bill), fut))
+        return fut
+
+    def reopen(self):
+        """Drop the writer's connection before its next batch (e.g. after a DB restore)."""
+        self._reopen.set()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._reopen.is_set() or self._conn is None:
+            self._reopen.clear()
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = get_conn(self.path)
+        return self._conn
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_rows:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._flush(batch)
 
-def update_bill_status(bill_no: str, status: str):
+    def _flush(self, batch):
+        try:
+            self._commit([params for params, _ in batch])
+        except sqlite3.OperationalError:
+            # lock / busy timeout or I/O error: nothing row-specific, so retry
+            # the whole batch once on a fresh connection, then fail it
+            self.reopen()
+            try:
+                self._commit([params for params, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                return
+        except (sqlite3.IntegrityError, sqlite3.InterfaceError):
+            # one bad row must not fail the whole group: retry rows one by one
+            self._flush_each(batch)
+            return
+        except Exception as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        for _, fut in batch:
+            fut.set_result(None)
+
+    def _flush_each(self, batch):
+        for i, (params, fut) in enumerate(batch):
+            try:
+                self._commit([params])
+            except sqlite3.OperationalError as e:
+                # the database itself is failing; don't wait it out once per row
+                for _, rest in batch[i:]:
+                    rest.set_exception(e)
+                return
+            except Exception as e:
+                fut.set_exception(e)
+            else:
+                fut.set_result(None)
+
+    def _commit(self, rows):
+        conn = self._connection()
+        with conn:
+            conn.executemany(BILL_INSERT_SQL, rows)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_bill_writer() -> BillWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BillWriter()
+        return _writer
+
+def save_bill_async(bill: dict) -> Future:
+    """Queue a bill for the next group commit; the Future resolves once it is durable."""
+    return get_bill_writer().submit(bill)
+
+def save_bill(bill: dict):
+    # synchronous: blocks until the batch containing this bill is committed
+    save_bill_async(bill).result()
+
+def update_bill_status(bill_no: str, status: str) -> int:
+    """Set a bill's status; returns the number of bills updated (0 if bill_no is unknown)."""
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("UPDATE bills SET status = ? WHERE bill_no = ?", (status, bill_no))
     conn.commit()
     conn.close()
+    return cur.rowcount
 
 def fetch_bills(date_from: str = None, date_to: str = None, customer_type: str = None, status: str = None):
     conn = get_conn()
@@ -124,6 +336,146 @@ def fetch_bills(date_from: str = None, date_to: str = None, customer_type: str =
         return pd.DataFrame()
     return pd.DataFrame([dict(r) for r in rows])
 
+def data_version(path: str = DB_PATH) -> tuple:
+    """
+    Cheap token that changes whenever any process commits to the database
+    (or it is restored). Its core is SQLite's file change counter (header
+    bytes 24-27), which every commit increments in rollback-journal mode, the
+    mode this app uses, so even a same-size UPDATE within one mtime tick is
+    seen. Size and mtime of the file (and of a WAL, if one exists) are
+    included too, which catches a restored file that happens to carry the
+    same counter.
+    """
+    version = ()
+    try:
+        with open(path, "rb") as f:
+            header = f.read(28)
+        version += (int.from_bytes(header[24:28], "big"),)
+    except FileNotFoundError:
+        pass
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        version += (st.st_size, st.st_mtime_ns)
+    return version
+
+# -------- Typed bill frames ----------
+# Standard in-memory format for reports, exports and analytics:
+#   id int64, bill_no str, customer_name category, customer_type category,
+#   status category, units float64, created_at datetime64,
+#   energy/fixed/gst/surcharge/total as int32 *_paise columns.
+# Target: at most BILL_FRAME_TARGET_BYTES_PER_ROW bytes per row (deep, incl.
+# string payloads) -- roughly half the object-dtype fetch_bills frame.
+BILL_FRAME_TARGET_BYTES_PER_ROW = 128
+BILL_FRAME_CHUNK = 200000
+CUSTOMER_TYPES = ["Domestic", "Commercial"]
+BILL_STATUSES = ["Unpaid", "Paid"]
+MONEY_COLUMNS = ["energy_charge", "fixed_charge", "gst", "surcharge", "total"]
+
+BILL_FRAME_SQL = """
+    SELECT id, bill_no, customer_name, customer_type, status, units, created_at,
+           CAST(ROUND(energy_charge * 100) AS INTEGER) AS energy_charge_paise,
+           CAST(ROUND(fixed_charge * 100) AS INTEGER) AS fixed_charge_paise,
+           CAST(ROUND(gst * 100) AS INTEGER) AS gst_paise,
+           CAST(ROUND(COALESCE(surcharge, 0) * 100) AS INTEGER) AS surcharge_paise,
+           CAST(ROUND(total * 100) AS INTEGER) AS total_paise
+    FROM bills WHERE 1=1
+"""
+
+def _known_categorical(values: pd.Series, known: list, column: str) -> pd.Categorical:
+    # known values keep fixed codes; anything else in the data becomes an extra
+    # category (with a warning) instead of silently turning into NaN
+    extra = sorted(set(values.dropna()) - set(known))
+    if extra:
+        warnings.warn(f"bills.{column} has unexpected values {extra}", stacklevel=4)
+    return pd.Categorical(values, categories=known + extra)
+
+def _typed_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk["customer_name"] = chunk["customer_name"].astype("category")
+    chunk["customer_type"] = _known_categorical(chunk["customer_type"], CUSTOMER_TYPES, "customer_type")
+    chunk["status"] = _known_categorical(chunk["status"], BILL_STATUSES, "status")
+    chunk["units"] = chunk["units"].astype("float64")
+    chunk["created_at"] = pd.to_datetime(chunk["created_at"], format="%Y-%m-%d %H:%M:%S")
+    for col in MONEY_COLUMNS:
+        chunk[f"{col}_paise"] = chunk[f"{col}_paise"].fillna(0).astype("int32")
+    return chunk
+
+def _bill_frame_filters(date_from: str = None, date_to: str = None, customer_type: str = None, status: str = None,
+                       customers_with_bills_after: int = None, max_id: int = None):
+    q = ""
+    params = []
+    if customer_type and customer_type != "All":
+        q += " AND customer_type = ?"
+        params.append(customer_type)
+    if status and status != "All":
+        q += " AND status = ?"
+        params.append(status)
+    if date_from:
+        q += " AND date(created_at) >= date(?)"
+        params.append(date_from)
+    if date_to:
+        q += " AND date(created_at) <= date(?)"
+        params.append(date_to)
+    if customers_with_bills_after is not None:
+        q += " AND customer_name IN (SELECT DISTINCT customer_name FROM bills WHERE id > ?)"
+        params.append(customers_with_bills_after)
+    if max_id is not None:
+        q += " AND id <= ?"
+        params.append(max_id)
+    return q, params
+
+def count_bills(date_from: str = None, date_to: str = None, customer_type: str = None, status: str = None,
+                path: str = DB_PATH) -> int:
+    where, params = _bill_frame_filters(date_from, date_to, customer_type, status)
+    conn = get_conn(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM bills WHERE 1=1" + where, params).fetchone()[0]
+    finally:
+        conn.close()
+
+def load_bill_frame(date_from: str = None, date_to: str = None, customer_type: str = None, status: str = None,
+                    customers_with_bills_after: int = None, max_id: int = None, limit: int = None,
+                    path: str = DB_PATH) -> pd.DataFrame:
+    """
+    Typed, compact equivalent of fetch_bills (same filters, newest first).
+    customers_with_bills_after=id restricts to customers that have a bill
+    with a larger id and max_id caps bill ids (used for incremental
+    analytics); limit caps the rows read in SQL. Rows are read and converted in chunks to keep peak memory low.
+    """
+    where, params = _bill_frame_filters(date_from, date_to, customer_type, status, customers_with_bills_after, max_id)
+    q = BILL_FRAME_SQL + where + " ORDER BY created_at DESC, id DESC"
+    if limit is not None:
+        q += " LIMIT ?"
+        params.append(limit)
+    conn = get_conn(path)
+    try:
+        chunks = [_typed_chunk(c) for c in pd.read_sql_query(q, conn, params=params, chunksize=BILL_FRAME_CHUNK)]
+        if not chunks:
+            return _typed_chunk(pd.read_sql_query(BILL_FRAME_SQL + " AND 0", conn))
+    finally:
+        conn.close()
+    # give every chunk the same categories so concat keeps the dtype
+    for col in ("customer_name", "customer_type", "status"):
+        categories = union_categoricals([c[col] for c in chunks]).categories
+        for c in chunks:
+            c[col] = c[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def bill_frame_bytes_per_row(df: pd.DataFrame) -> float:
+    """Deep memory per row; compare against BILL_FRAME_TARGET_BYTES_PER_ROW."""
+    return df.memory_usage(deep=True).sum() / max(len(df), 1)
+
+def bill_frame_rupees(df: pd.DataFrame) -> pd.DataFrame:
+    """Rupee view of a typed bill frame (for display, CSV and JSON), in fetch_bills column layout."""
+    out = df.drop(columns=[f"{c}_paise" for c in MONEY_COLUMNS])
+    for col in MONEY_COLUMNS:
+        out[col] = df[f"{col}_paise"].to_numpy(dtype=np.int64) / 100
+    cols = ["id", "bill_no", "customer_name", "customer_type", "units", "energy_charge", "fixed_charge",
+            "gst", "total", "status", "created_at", "surcharge"]
+    return out[cols]
+
 # -------- Backup / Restore ----------
 def backup_db_bytes() -> bytes:
     with open(DB_PATH, "rb") as f:
@@ -132,3 +484,5 @@ def backup_db_bytes() -> bytes:
 def restore_db_bytes(b: bytes):
     with open(DB_PATH, "wb") as f:
         f.write(b)
+    if _writer is not None:
+        _writer.reopen()
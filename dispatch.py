@@ -0,0 +1,434 @@
+# dispatch.py
+# Bill dispatch pipeline: e-mail every customer their PDF after a billing cycle.
+#
+#   python dispatch.py --date-from 2025-11-01 --date-to 2025-11-30 --smtp-host mail.example.com --starttls
+#   python dispatch.py --contacts contacts.csv         # import customer_name,email rows first
+#   python dispatch.py --sink --smtp-port 1025          # local SMTP stand-in for testing
+#
+# Stages: bills are streamed from the DB in id order, rendered to PDF in a
+# process pool and handed to a bounded queue; a fixed number of sender tasks
+# deliver over SMTP (one reused connection each) with retries and exponential
+# backoff. Every outcome is written to bill_deliveries in batches, and bills
+# already 'sent' are skipped on reruns.
+
+import argparse
+import asyncio
+import csv
+import datetime
+import os
+import random
+import smtplib
+import time
+from concurrent.futures import ProcessPoolExecutor
+from email.message import EmailMessage
+from typing import Optional
+
+from database import DB_PATH, get_conn, init_db, set_customer_email
+from utils import generate_bill_pdf_bytes
+
+MAX_CONCURRENCY = 8        # simultaneous SMTP deliveries
+MAX_BACKLOG = 64           # rendered-or-rendering bills waiting for a sender
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0         # seconds; doubles per attempt, with jitter
+STREAM_CHUNK = 500
+PROGRESS_EVERY = 5.0       # seconds between progress lines
+LEDGER_BATCH = 200         # delivery outcomes per bill_deliveries transaction
+LEDGER_FLUSH_EVERY = 1.0   # seconds; bounds the outcomes a crash can lose
+
+RECORD_DELIVERY_SQL = """
+    INSERT INTO bill_deliveries (bill_id, bill_no, recipient, status, attempts, last_error, sent_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(bill_id) DO UPDATE SET recipient = excluded.recipient, status = excluded.status,
+        attempts = bill_deliveries.attempts + excluded.attempts, last_error = excluded.last_error,
+        sent_at = excluded.sent_at, updated_at = excluded.updated_at
+"""
+
+# bills not yet delivered, in id order after the keyset cursor
+PENDING_BILLS_SQL = """
+    SELECT b.*, c.email AS recipient
+    FROM bills b
+    LEFT JOIN customer_contacts c ON c.customer_name = b.customer_name
+    LEFT JOIN bill_deliveries d ON d.bill_id = b.id
+    WHERE b.id > ? AND (d.status IS NULL OR d.status != 'sent')
+"""
+
+
+class SMTPSettings:
+    def __init__(self, host: str = "localhost", port: int = 25, username: str = None, password: str = None,
+                 starttls: bool = False, sender: str = "billing@electricityboard.com", timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.sender = sender
+        self.timeout = timeout
+
+
+class SMTPSession:
+    """
+    One sender task's SMTP connection: opened (EHLO, STARTTLS, LOGIN) on first
+    use and reused for every later message, so the handshake is paid once per
+    task rather than once per bill. Blocking; call through asyncio.to_thread.
+    """
+
+    def __init__(self, settings: SMTPSettings):
+        self.settings = settings
+        self.server = None
+
+    def _connect(self) -> smtplib.SMTP:
+        s = self.settings
+        server = smtplib.SMTP(s.host, s.port, timeout=s.timeout)
+        try:
+            if s.starttls:
+                server.starttls()
+            if s.username:
+                server.login(s.username, s.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def send(self, msg: EmailMessage):
+        if self.server is None:
+            self.server = self._connect()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # the server dropped an idle or recycled connection: reconnect once
+            self.close()
+            self.server = self._connect()
+            self._send_or_close(msg)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # the server answered (and smtplib reset the transaction), so the
+            # connection is still usable; the caller decides about retrying
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    def _send_or_close(self, msg: EmailMessage):
+        try:
+            self.server.send_message(msg)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+
+def _render(bill: dict) -> bytes:
+    # module-level so it can run in the process pool
+    return generate_bill_pdf_bytes(bill)
+
+def _build_message(bill: dict, pdf: bytes, sender: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = bill["recipient"]
+    msg["Subject"] = f"Your electricity bill {bill['bill_no']}"
+    msg.set_content(
+        f"Dear {bill['customer_name']},\n\n"
+        f"Please find attached your electricity bill {bill['bill_no']} for ₹ {bill['total']:,.2f}.\n"
+        f"Please pay within 15 days. Late payment may attract surcharge.\n\n"
+        f"Electricity Board Pvt. Ltd."
+    )
+    msg.add_attachment(pdf, maintype="application", subtype="pdf", filename=f"{bill['bill_no']}.pdf")
+    return msg
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    return isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+
+class BillDispatcher:
+    def __init__(self, smtp: SMTPSettings, path: str = DB_PATH, date_from: str = None, date_to: str = None,
+                 concurrency: int = MAX_CONCURRENCY, backlog: int = MAX_BACKLOG, max_attempts: int = MAX_ATTEMPTS,
+                 backoff_base: float = BACKOFF_BASE, render_workers: Optional[int] = None):
+        self.smtp = smtp
+        self.path = path
+        self.date_from = date_from
+        self.date_to = date_to
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.render_workers = render_workers
+        self.queue = asyncio.Queue(maxsize=backlog)
+        self.stats = {"sent": 0, "failed": 0, "no_contact": 0, "retries": 0, "errors": 0, "max_backlog": 0}
+        self._ledger = []              # bill_deliveries rows not yet written
+        self._ledger_lock = asyncio.Lock()
+        self._ledger_conn = None
+
+    # ---- DB (blocking; always called through asyncio.to_thread) ----
+    def _pending_chunk(self, after_id: int) -> list:
+        q = PENDING_BILLS_SQL
+        params = [after_id]
+        if self.date_from:
+            q += " AND date(b.created_at) >= date(?)"
+            params.append(self.date_from)
+        if self.date_to:
+            q += " AND date(b.created_at) <= date(?)"
+            params.append(self.date_to)
+        q += " ORDER BY b.id LIMIT ?"
+        params.append(STREAM_CHUNK)
+        conn = get_conn(self.path)
+        try:
+            return [dict(r) for r in conn.execute(q, params).fetchall()]
+        finally:
+            conn.close()
+
+    def _write_ledger(self, rows: list):
+        # one long-lived connection; flushes are serialized by _ledger_lock
+        if self._ledger_conn is None:
+            self._ledger_conn = get_conn(self.path)
+        with self._ledger_conn:
+            self._ledger_conn.executemany(RECORD_DELIVERY_SQL, rows)
+
+    async def _flush_ledger(self):
+        async with self._ledger_lock:
+            rows, self._ledger = self._ledger, []
+            if not rows:
+                return
+            try:
+                await asyncio.to_thread(self._write_ledger, rows)
+            except Exception:
+                # keep them for the next flush
+                self._ledger[:0] = rows
+                raise
+
+    async def _record(self, bill: dict, status: str, attempts: int, error: str = None):
+        now = datetime.datetime.now().isoformat()
+        self._ledger.append((bill["id"], bill["bill_no"], bill.get("recipient"), status, attempts, error,
+                             now if status == "sent" else None, now))
+        if len(self._ledger) >= LEDGER_BATCH:
+            await self._flush_ledger()
+
+    # ---- pipeline stages ----
+    async def _produce(self, pool: ProcessPoolExecutor):
+        loop = asyncio.get_running_loop()
+        after_id = 0
+        while True:
+            chunk = await asyncio.to_thread(self._pending_chunk, after_id)
+            if not chunk:
+                break
+            for bill in chunk:
+                if not bill.get("recipient"):
+                    self.stats["no_contact"] += 1
+                    await self._record(bill, "no_contact", 0)
+                    continue
+                render = loop.run_in_executor(pool, _render, bill)
+                # blocks once `backlog` bills are in flight, which also caps pending renders
+                await self.queue.put((bill, render))
+                self.stats["max_backlog"] = max(self.stats["max_backlog"], self.queue.qsize())
+            after_id = chunk[-1]["id"]
+
+    async def _deliver_one(self, bill: dict, render: asyncio.Future, session: SMTPSession):
+        try:
+            msg = _build_message(bill, await render, self.smtp.sender)
+        except Exception as e:
+            self.stats["failed"] += 1
+            await self._record(bill, "failed", 0, f"render: {e}")
+            return
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await asyncio.to_thread(session.send, msg)
+            except Exception as e:
+                if attempt < self.max_attempts and _is_transient(e):
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(self.backoff_base * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                    continue
+                self.stats["failed"] += 1
+                await self._record(bill, "failed", attempt, str(e))
+                return
+            self.stats["sent"] += 1
+            await self._record(bill, "sent", attempt)
+            return
+
+    async def _sender(self):
+        session = SMTPSession(self.smtp)
+        try:
+            while True:
+                bill, render = await self.queue.get()
+                try:
+                    await self._deliver_one(bill, render, session)
+                except Exception as e:
+                    # e.g. a ledger flush failed ("database is locked"); its rows
+                    # stay queued for the next flush. Never let one bill take the
+                    # sender down.
+                    self.stats["errors"] += 1
+                    print(f"dispatch error for {bill['bill_no']}: {type(e).__name__}: {e}")
+                finally:
+                    self.queue.task_done()
+        finally:
+            # QUIT is a network round trip; keep it off the event loop
+            await asyncio.to_thread(session.close)
+
+    async def _work(self, pool: ProcessPoolExecutor):
+        await self._produce(pool)
+        await self.queue.join()
+
+    async def _flush_ledger_periodically(self):
+        while True:
+            await asyncio.sleep(LEDGER_FLUSH_EVERY)
+            try:
+                await self._flush_ledger()
+            except Exception as e:
+                print(f"ledger flush failed, will retry: {type(e).__name__}: {e}")
+
+    async def _report(self, started: float):
+        while True:
+            await asyncio.sleep(PROGRESS_EVERY)
+            print(self.progress(started))
+
+    def progress(self, started: float) -> str:
+        elapsed = time.perf_counter() - started
+        st = self.stats
+        return (f"sent={st['sent']} failed={st['failed']} no_contact={st['no_contact']} retries={st['retries']} errors={st['errors']} "
+                f"backlog={self.queue.qsize()} (max {st['max_backlog']}) "
+                f"throughput={st['sent'] / elapsed if elapsed else 0:.1f} bills/s")
+
+    async def run(self) -> dict:
+        init_db(self.path)
+        started = time.perf_counter()
+        senders = [asyncio.create_task(self._sender()) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report(started))
+        flusher = asyncio.create_task(self._flush_ledger_periodically())
+        try:
+            with ProcessPoolExecutor(self.render_workers) as pool:
+                work = asyncio.create_task(self._work(pool))
+                # senders only end by crashing; fail the run rather than wait on
+                # a queue nobody drains
+                await asyncio.wait([work, *senders], return_when=asyncio.FIRST_COMPLETED)
+                if not work.done():
+                    work.cancel()
+                    crashed = next(t for t in senders if t.done())
+                    raise RuntimeError("bill sender task stopped unexpectedly") from crashed.exception()
+                work.result()
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+            # a failure here fails the run; unwritten bills are resent next run
+            await self._flush_ledger()
+        finally:
+            for t in senders + [reporter, flusher]:
+                t.cancel()
+            await asyncio.gather(*senders, reporter, flusher, return_exceptions=True)
+            if self._ledger_conn is not None:
+                self._ledger_conn.close()
+                self._ledger_conn = None
+        elapsed = time.perf_counter() - started
+        print(self.progress(started))
+        return {**self.stats, "elapsed": round(elapsed, 2),
+                "throughput": round(self.stats["sent"] / elapsed, 2) if elapsed else 0.0}
+
+
+# ---- local SMTP stand-in ----
+class SMTPSink:
+    """
+    Minimal asyncio SMTP server that accepts and counts messages. With
+    fail_every=N every Nth message is answered with a 451 (transient) error,
+    to exercise retries.
+    """
+
+    def __init__(self, fail_every: int = 0):
+        self.fail_every = fail_every
+        self.received = 0
+        self.seen = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(line: str):
+            writer.write((line + "\r\n").encode())
+        reply("220 localhost sink ready")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                cmd = line.decode("latin-1").strip().upper()
+                if cmd.startswith(("EHLO", "HELO")):
+                    reply("250 localhost")
+                elif cmd.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                    reply("250 OK")
+                elif cmd == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b".\n", b""):
+                        pass
+                    self.seen += 1
+                    if self.fail_every and self.seen % self.fail_every == 0:
+                        reply("451 Try again later")
+                    else:
+                        self.received += 1
+                        reply("250 Queued")
+                elif cmd == "QUIT":
+                    reply("221 Bye")
+                    break
+                else:
+                    reply("502 Not implemented")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 1025) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def import_contacts(csv_path: str, path: str = DB_PATH) -> int:
+    """Load customer_name,email rows into customer_contacts."""
+    init_db(path)
+    n = 0
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            set_customer_email(row["customer_name"], row["email"], path)
+            n += 1
+    return n
+
+async def _serve_sink(host: str, port: int, fail_every: int):
+    sink = SMTPSink(fail_every)
+    server = await sink.start(host, port)
+    print(f"SMTP sink listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="E-mail bill PDFs to customers")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--date-from")
+    parser.add_argument("--date-to")
+    parser.add_argument("--contacts", help="CSV with customer_name,email columns to import before sending")
+    parser.add_argument("--smtp-host", default=os.environ.get("SMTP_HOST", "localhost"))
+    parser.add_argument("--smtp-port", type=int, default=int(os.environ.get("SMTP_PORT", "25")))
+    parser.add_argument("--smtp-user", default=os.environ.get("SMTP_USER"))
+    parser.add_argument("--starttls", action="store_true")
+    parser.add_argument("--sender", default=os.environ.get("MAIL_FROM", "billing@electricityboard.com"))
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY)
+    parser.add_argument("--backlog", type=int, default=MAX_BACKLOG)
+    parser.add_argument("--sink", action="store_true", help="run a local SMTP stand-in instead of dispatching")
+    parser.add_argument("--sink-fail-every", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.sink:
+        try:
+            asyncio.run(_serve_sink(args.smtp_host, args.smtp_port, args.sink_fail_every))
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.contacts:
+        print(f"Imported {import_contacts(args.contacts, args.db)} contacts")
+    smtp = SMTPSettings(args.smtp_host, args.smtp_port, args.smtp_user, os.environ.get("SMTP_PASSWORD"),
+                        args.starttls, args.sender)
+    dispatcher = BillDispatcher(smtp, args.db, args.date_from, args.date_to, args.concurrency, args.backlog)
+    print(asyncio.run(dispatcher.run()))
+
+if __name__ == "__main__":
+    main()
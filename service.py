@@ -0,0 +1,366 @@
+# service.py
+# Headless HTTP/JSON billing service (asyncio, stdlib only)
+#
+#   python service.py --host 0.0.0.0 --port 8600
+#   python service.py --load-test --seconds 10 --concurrency 64
+#
+# Endpoints:
+#   GET  /health
+#   POST /quote                  {"units": 120, "customer_type": "Domestic"}
+#   POST /bills                  {"customer_name": ..., "customer_type": ..., "units": ..., "status": "Unpaid"}
+#   POST /bills/bulk             {"bills": [{...}, ...]}
+#   POST /bills/<bill_no>/status {"status": "Paid"}
+#   GET  /bills?date_from=YYYY-MM-DD&date_to=...&customer_type=...&status=...&limit=100
+
+import argparse
+import asyncio
+import json
+import math
+import time
+from http import HTTPStatus
+from typing import Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from database import init_db, save_bill_async, update_bill_status, load_bill_frame, bill_frame_rupees, count_bills
+from backend import calculate_bills, make_bills
+
+# quote micro-batching: concurrent quotes are priced together once this many
+# are pending or the first one has waited QUOTE_BATCH_WINDOW seconds
+QUOTE_BATCH_MAX = 1024
+QUOTE_BATCH_WINDOW = 0.002
+MAX_BODY_BYTES = 10 * 1024 * 1024
+BILL_STATUSES = ("Paid", "Unpaid")
+CUSTOMER_TYPES = ("Domestic", "Commercial")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class QuoteBatcher:
+    """Collects concurrent quote requests and prices them with one calculate_bills call."""
+
+    def __init__(self, max_batch: int = QUOTE_BATCH_MAX, window: float = QUOTE_BATCH_WINDOW):
+        self.max_batch = max_batch
+        self.window = window
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def quote(self, units: float, customer_type: str) -> dict:
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((units, customer_type, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self._price(batch)
+
+    def _price(self, batch):
+        try:
+            priced = calculate_bills([b[0] for b in batch], [b[1] for b in batch])
+        except Exception as e:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for i, (units, customer_type, fut) in enumerate(batch):
+            if fut.done():  # client went away
+                continue
+            if not priced["valid"][i]:
+                fut.set_exception(HTTPError(400, f"Unit value exceeds permissible usage range for {customer_type.lower()}. Please recheck input."))
+                continue
+            fut.set_result({
+                "units": units,
+                "customer_type": customer_type,
+                "energy_charge": float(priced["energy_charge"][i]),
+                "fixed_charge": float(priced["fixed_charge"][i]),
+                "gst": float(priced["gst"][i]),
+                "total": float(priced["total"][i]),
+            })
+
+
+# ---- request validation ----
+def _units(body: dict) -> float:
+    try:
+        units = float(body.get("units") or 0.0)
+    except (TypeError, ValueError):
+        raise HTTPError(400, "units must be a number")
+    if not math.isfinite(units):
+        raise HTTPError(400, "units must be a finite number")
+    if units < 0:
+        raise HTTPError(400, "units must not be negative")
+    return units
+
+def _customer_type(body: dict) -> str:
+    customer_type = body.get("customer_type")
+    if customer_type not in CUSTOMER_TYPES:
+        raise HTTPError(400, f"customer_type must be one of {', '.join(CUSTOMER_TYPES)}")
+    return customer_type
+
+def _bill_row(body: dict) -> dict:
+    if not isinstance(body, dict):
+        raise HTTPError(400, "bill must be a JSON object")
+    if not body.get("customer_name"):
+        raise HTTPError(400, "customer_name is required")
+    status = body.get("status", "Unpaid")
+    if status not in BILL_STATUSES:
+        raise HTTPError(400, f"status must be one of {', '.join(BILL_STATUSES)}")
+    return {
+        "customer_name": body["customer_name"],
+        "customer_type": _customer_type(body),
+        "units": _units(body),
+        "status": status,
+    }
+
+
+class BillingService:
+    def __init__(self):
+        self.quotes = QuoteBatcher()
+
+    # ---- handlers ----
+    async def health(self, query, body):
+        return 200, {"status": "ok"}
+
+    async def quote(self, query, body):
+        return 200, await self.quotes.quote(_units(body), _customer_type(body))
+
+    async def create_bill(self, query, body):
+        row = _bill_row(body)
+        bill = make_bills([row])[0]
+        if "error" in bill:
+            raise HTTPError(400, bill["error"])
+        await asyncio.wrap_future(save_bill_async(bill))
+        return 201, bill
+
+    async def bulk_create(self, query, body):
+        items = body.get("bills")
+        if not isinstance(items, list) or not items:
+            raise HTTPError(400, "bills must be a non-empty list")
+        results, rows, slots = [None] * len(items), [], []
+        for i, item in enumerate(items):
+            try:
+                rows.append(_bill_row(item))
+                slots.append(i)
+            except HTTPError as e:
+                results[i] = {"error": e.message}
+        pending, saving = [], []
+        for i, bill in zip(slots, make_bills(rows)):
+            results[i] = bill
+            if "error" not in bill:
+                pending.append(asyncio.wrap_future(save_bill_async(bill)))
+                saving.append(i)
+        # every bill rides the writer's group commit; wait for all of them and
+        # report failed saves per item, since the others are already committed
+        for i, outcome in zip(saving, await asyncio.gather(*pending, return_exceptions=True)):
+            if isinstance(outcome, Exception):
+                results[i] = {"error": f"bill could not be saved: {outcome}"}
+        created = sum(1 for r in results if "error" not in r)
+        return 201, {"created": created, "failed": len(results) - created, "bills": results}
+
+    async def update_status(self, query, body, bill_no):
+        status = body.get("status")
+        if status not in BILL_STATUSES:
+            raise HTTPError(400, f"status must be one of {', '.join(BILL_STATUSES)}")
+        updated = await asyncio.get_running_loop().run_in_executor(None, update_bill_status, bill_no, status)
+        if not updated:
+            raise HTTPError(404, f"no bill {bill_no}")
+        return 200, {"bill_no": bill_no, "status": status}
+
+    async def query_bills(self, query, body):
+        args = {k: query[k][0] for k in ("date_from", "date_to", "customer_type", "status") if k in query}
+        try:
+            limit = int(query.get("limit", ["100"])[0])
+        except ValueError:
+            raise HTTPError(400, "limit must be an integer")
+        if limit < 1:
+            raise HTTPError(400, "limit must be at least 1")
+        loop = asyncio.get_running_loop()
+        total = await loop.run_in_executor(None, lambda: count_bills(**args))
+        df = await loop.run_in_executor(None, lambda: load_bill_frame(**args, limit=limit))
+        return 200, {"count": total, "bills": bill_frame_rupees(df).to_dict(orient="records")}
+
+    def route(self, method: str, path: str):
+        parts = [p for p in path.split("/") if p]
+        if method == "GET" and parts == ["health"]:
+            return self.health
+        if method == "POST" and parts == ["quote"]:
+            return self.quote
+        if parts[:1] == ["bills"]:
+            if method == "GET" and len(parts) == 1:
+                return self.query_bills
+            if method == "POST" and len(parts) == 1:
+                return self.create_bill
+            if method == "POST" and parts[1:] == ["bulk"]:
+                return self.bulk_create
+            if method == "POST" and len(parts) == 3 and parts[2] == "status":
+                return lambda query, body: self.update_status(query, body, parts[1])
+        raise HTTPError(404, f"no route for {method} {path}")
+
+    async def dispatch(self, method: str, target: str, raw_body: bytes) -> Tuple[int, dict]:
+        url = urlsplit(target)
+        try:
+            handler = self.route(method, url.path)
+            body = json.loads(raw_body) if raw_body else {}
+            if not isinstance(body, dict):
+                raise HTTPError(400, "request body must be a JSON object")
+            return await handler(parse_qs(url.query), body)
+        except HTTPError as e:
+            return e.status, {"error": e.message}
+        except json.JSONDecodeError:
+            return 400, {"error": "invalid JSON body"}
+        except Exception as e:
+            return 500, {"error": str(e)}
+
+    # ---- HTTP/1.1 plumbing (keep-alive, Content-Length bodies) ----
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, raw_body = request
+                status, payload = await self.dispatch(method, target, raw_body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HTTPError as e:
+            writer.write(_response(e.status, {"error": e.message}, False))
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        self.quotes.start()
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[tuple]:
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = h.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0) or 0)
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "request body too large")
+    raw_body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, raw_body
+
+def _response(status: int, payload: dict, keep_alive: bool = True) -> bytes:
+    body = json.dumps(payload, default=str).encode()
+    head = (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+# ---- local load test ----
+async def _load_client(host: str, port: int, stop_at: float, counts: list, i: int):
+    reader, writer = await asyncio.open_connection(host, port)
+    ctype = CUSTOMER_TYPES[i % 2]
+    n = 0
+    try:
+        while time.perf_counter() < stop_at:
+            body = json.dumps({"units": 50 + (n * 37 + i) % 900, "customer_type": ctype}).encode()
+            writer.write(
+                b"POST /quote HTTP/1.1\r\nHost: load\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            length = 0
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b""):
+                    break
+                if h.lower().startswith(b"content-length:"):
+                    length = int(h.split(b":")[1])
+            await reader.readexactly(length)
+            n += 1
+    finally:
+        counts[i] = n
+        writer.close()
+
+async def load_test(seconds: float = 5.0, concurrency: int = 64, host: str = "127.0.0.1", port: int = 0):
+    """Run the service in-process and hammer POST /quote from `concurrency` keep-alive clients."""
+    service = BillingService()
+    server = await service.start(host, port)
+    port = server.sockets[0].getsockname()[1]
+    counts = [0] * concurrency
+    started = time.perf_counter()
+    await asyncio.gather(*(_load_client(host, port, started + seconds, counts, i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    server.close()
+    await server.wait_closed()
+    await service.quotes.stop()
+    total = sum(counts)
+    print(f"quote load test: {total} requests in {elapsed:.2f}s from {concurrency} clients "
+          f"-> {total / elapsed:,.0f} req/s")
+    return total / elapsed
+
+
+async def serve(host: str, port: int):
+    init_db()
+    service = BillingService()
+    server = await service.start(host, port)
+    print(f"Billing service listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless electricity billing HTTP service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--load-test", action="store_true", help="run a local quote load test and exit")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+    if args.load_test:
+        asyncio.run(load_test(args.seconds, args.concurrency))
+    else:
+        try:
+            asyncio.run(serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# surcharge.py
+# Late-payment surcharge batch job (run daily from cron / a scheduler)
+#
+#   python surcharge.py                   # as of today
+#   python surcharge.py --as-of 2025-12-31 --chunk-size 50000
+#
+# Bills are due PAYMENT_DUE_DAYS after issue. Every Unpaid bill past its due
+# date gets one surcharge record (LATE_SURCHARGE_RATE of its total) and the
+# amount is folded into bills.total.
+
+import argparse
+import datetime
+from database import DB_PATH, get_conn, init_db
+
+PAYMENT_DUE_DAYS = 15
+LATE_SURCHARGE_RATE = 0.02
+CHUNK_SIZE = 20000
+
+# overdue candidates are Unpaid bills without a surcharge yet; this predicate
+# matches the partial index idx_bills_unsurcharged, so bills surcharged on
+# earlier days are not rescanned
+PENDING = "status = 'Unpaid' AND COALESCE(surcharge, 0) = 0"
+PENDING_INDEX = "INDEXED BY idx_bills_unsurcharged"
+
+# one chunk of overdue bills in (created_at, id) order after the cursor
+CHUNK_END_SQL = f"""
+    SELECT created_at, id FROM bills {PENDING_INDEX}
+    WHERE {PENDING} AND created_at < :cutoff
+      AND (created_at, id) > (:cur_created_at, :cur_id)
+    ORDER BY created_at, id
+    LIMIT 1 OFFSET :offset
+"""
+
+CHUNK_FILTER = """
+    b.status = 'Unpaid' AND COALESCE(b.surcharge, 0) = 0 AND b.created_at < :cutoff
+    AND (b.created_at, b.id) > (:cur_created_at, :cur_id)
+    AND (b.created_at, b.id) <= (:end_created_at, :end_id)
+"""
+
+INSERT_SURCHARGES_SQL = f"""
+    INSERT OR IGNORE INTO bill_surcharges (bill_id, bill_no, due_date, days_overdue, amount, job, created_at)
+    SELECT b.id, b.bill_no,
+           date(b.created_at, '+{PAYMENT_DUE_DAYS} days'),
+           CAST(julianday(:as_of) - julianday(date(b.created_at, '+{PAYMENT_DUE_DAYS} days')) AS INTEGER),
+           ROUND(b.total * :rate, 2), :job, :now
+    FROM bills b {PENDING_INDEX}
+    WHERE {CHUNK_FILTER}
+"""
+
+# only bills whose surcharge record was inserted by this chunk (id > mark)
+APPLY_SURCHARGES_SQL = """
+    UPDATE bills
+    SET surcharge = (SELECT s.amount FROM bill_surcharges s WHERE s.bill_id = bills.id),
+        total = ROUND(total + (SELECT s.amount FROM bill_surcharges s WHERE s.bill_id = bills.id), 2)
+    WHERE id IN (SELECT bill_id FROM bill_surcharges WHERE id > :mark)
+      AND COALESCE(surcharge, 0) = 0
+"""
+
+def overdue_cutoff(as_of: datetime.date) -> str:
+    """Bills created before this timestamp are past their due date on as_of."""
+    return (as_of - datetime.timedelta(days=PAYMENT_DUE_DAYS)).strftime("%Y-%m-%d 00:00:00")
+
+def run_late_surcharge(as_of: datetime.date = None, chunk_size: int = CHUNK_SIZE, path: str = DB_PATH,
+                       rate: float = LATE_SURCHARGE_RATE) -> dict:
+    """
+    Apply late-payment surcharges for all bills overdue on `as_of`.
+
+    Work is done in chunks of `chunk_size` overdue bills. Each chunk is one
+    transaction that inserts the surcharge records, updates the bill totals
+    and advances the job cursor, so an interrupted run resumes after the last
+    committed chunk. Bills that already carry a surcharge are never scanned
+    again, so each daily run only touches newly overdue bills, and re-running
+    is a no-op (bill_surcharges.bill_id is also unique).
+    """
+    as_of = as_of or datetime.date.today()
+    job = f"late_surcharge:{as_of.isoformat()}"
+    cutoff = overdue_cutoff(as_of)
+    init_db(path)
+    conn = get_conn(path)
+    try:
+        row = conn.execute("SELECT * FROM batch_jobs WHERE job = ?", (job,)).fetchone()
+        if row is None:
+            cur_created_at, cur_id, rows_done = "", 0, 0
+            with conn:
+                conn.execute(
+                    "INSERT INTO batch_jobs (job, cursor_created_at, cursor_id, rows_done, status, updated_at) VALUES (?, ?, ?, 0, 'running', ?)",
+                    (job, cur_created_at, cur_id, datetime.datetime.now().isoformat())
+                )
+        else:
+            cur_created_at, cur_id, rows_done = row["cursor_created_at"], row["cursor_id"], row["rows_done"]
+        resumed_from = rows_done
+        surcharged = 0
+
+        while True:
+            params = {"cutoff": cutoff, "cur_created_at": cur_created_at, "cur_id": cur_id}
+            end = conn.execute(CHUNK_END_SQL, {**params, "offset": chunk_size - 1}).fetchone()
+            if end is None:
+                # last (partial) chunk runs to the final overdue bill
+                end = conn.execute(
+                    f"SELECT created_at, id FROM bills {PENDING_INDEX} WHERE {PENDING} AND created_at < ? ORDER BY created_at DESC, id DESC LIMIT 1",
+                    (cutoff,)
+                ).fetchone()
+                if end is None or (end["created_at"], end["id"]) <= (cur_created_at, cur_id):
+                    break
+            params.update(end_created_at=end["created_at"], end_id=end["id"])
+            with conn:
+                # counted before the update below takes these bills out of PENDING
+                chunk_rows = conn.execute(f"SELECT COUNT(*) FROM bills b {PENDING_INDEX} WHERE {CHUNK_FILTER}", params).fetchone()[0]
+                mark = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bill_surcharges").fetchone()[0]
+                conn.execute(INSERT_SURCHARGES_SQL, {
+                    **params, "as_of": as_of.isoformat(), "rate": rate, "job": job,
+                    "now": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                })
+                n = conn.execute(APPLY_SURCHARGES_SQL, {"mark": mark}).rowcount
+                rows_done += chunk_rows
+                cur_created_at, cur_id = end["created_at"], end["id"]
+                conn.execute(
+                    "UPDATE batch_jobs SET cursor_created_at = ?, cursor_id = ?, rows_done = ?, updated_at = ? WHERE job = ?",
+                    (cur_created_at, cur_id, rows_done, datetime.datetime.now().isoformat(), job)
+                )
+            surcharged += n
+
+        with conn:
+            conn.execute("UPDATE batch_jobs SET status = 'done', updated_at = ? WHERE job = ?",
+                         (datetime.datetime.now().isoformat(), job))
+        total_amount = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM bill_surcharges WHERE job = ?", (job,)).fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        "job": job,
+        "cutoff": cutoff,
+        "overdue_scanned": rows_done - resumed_from,
+        "resumed_from": resumed_from,
+        "surcharged": surcharged,
+        "job_surcharge_total": round(total_amount, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply late-payment surcharges to overdue Unpaid bills")
+    parser.add_argument("--as-of", type=datetime.date.fromisoformat, default=None, help="YYYY-MM-DD (default: today)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+    print(run_late_surcharge(args.as_of, args.chunk_size, args.db))
+
+if __name__ == "__main__":
+    main()
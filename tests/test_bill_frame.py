@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import (BILL_FRAME_TARGET_BYTES_PER_ROW, BILL_INSERT_SQL, MONEY_COLUMNS, bill_frame_bytes_per_row,
+                      bill_frame_rupees, init_db, load_bill_frame)
+
+ROWS = 5000
+CUSTOMERS = 50
+
+
+def _bill(i):
+    customer_type = "Domestic" if i % 3 else "Commercial"
+    units = (i * 37) % 900 + 0.5 * (i % 2)
+    energy = round(units * 1.75, 2)
+    fixed = 50.0 if customer_type == "Domestic" else 100.0
+    gst = round(energy * 0.18, 2)
+    return (
+        f"BILL{i:09d}", f"Customer {i % CUSTOMERS}", customer_type, units,
+        energy, fixed, gst, round(energy + fixed + gst, 2),
+        "Paid" if i % 4 == 0 else "Unpaid",
+        f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d} {i % 24:02d}:{i % 60:02d}:00",
+    )
+
+
+@pytest.fixture
+def bill_db(tmp_path):
+    path = str(tmp_path / "bills.db")
+    init_db(path)
+    rows = [_bill(i) for i in range(ROWS)]
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(BILL_INSERT_SQL, rows)
+        # one bill carries a late-payment surcharge
+        conn.execute("UPDATE bills SET surcharge = 12.34, total = ROUND(total + 12.34, 2) WHERE bill_no = ?",
+                     (rows[7][0],))
+    conn.close()
+    return path, rows
+
+
+def test_bill_frame_dtypes(bill_db):
+    path, _ = bill_db
+    df = load_bill_frame(path=path)
+    assert len(df) == ROWS
+    for col in ("customer_name", "customer_type", "status"):
+        assert isinstance(df[col].dtype, pd.CategoricalDtype), col
+    assert list(df["customer_type"].cat.categories) == ["Domestic", "Commercial"]
+    assert df["customer_name"].cat.categories.size == CUSTOMERS
+    assert pd.api.types.is_datetime64_dtype(df["created_at"])
+    for col in MONEY_COLUMNS:
+        assert df[f"{col}_paise"].dtype == np.int32, col
+    assert df["units"].dtype == np.float64
+
+
+def test_bill_frame_paise_round_trip(bill_db):
+    path, rows = bill_db
+    out = bill_frame_rupees(load_bill_frame(path=path))
+    assert list(out.columns) == ["id", "bill_no", "customer_name", "customer_type", "units", "energy_charge",
+                                 "fixed_charge", "gst", "total", "status", "created_at", "surcharge"]
+    out = out.set_index("bill_no")
+    conn = sqlite3.connect(path)
+    expected = pd.read_sql_query(
+        "SELECT bill_no, energy_charge, fixed_charge, gst, COALESCE(surcharge, 0) AS surcharge, total FROM bills",
+        conn, index_col="bill_no")
+    conn.close()
+    for col in MONEY_COLUMNS:
+        assert (out.loc[expected.index, col].to_numpy() == expected[col].to_numpy()).all(), col
+    assert out.loc[rows[7][0], "surcharge"] == 12.34
+
+
+def test_bill_frame_memory_target(bill_db):
+    path, _ = bill_db
+    df = load_bill_frame(path=path)
+    assert bill_frame_bytes_per_row(df) <= BILL_FRAME_TARGET_BYTES_PER_ROW
+
+
+def test_bill_frame_keeps_unexpected_categories(bill_db):
+    path, rows = bill_db
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("UPDATE bills SET status = 'paid', customer_type = 'Industrial' WHERE bill_no = ?", (rows[3][0],))
+    conn.close()
+    with pytest.warns(UserWarning, match="unexpected values"):
+        df = load_bill_frame(path=path)
+    assert df["status"].notna().all() and df["customer_type"].notna().all()
+    row = df.set_index("bill_no").loc[rows[3][0]]
+    assert (row["status"], row["customer_type"]) == ("paid", "Industrial")
+    assert list(df["customer_type"].cat.categories) == ["Domestic", "Commercial", "Industrial"]
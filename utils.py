@@ -9,8 +9,13 @@ from reportlab.lib.utils import ImageReader
 import io
 import datetime
 import os
+import numpy as np
+import pandas as pd
 from PIL import Image
 
+# upper bound on points sent to the browser per chart series
+CHART_MAX_POINTS = 500
+
 def generate_bill_pdf_bytes(bill: dict, logo_path: str = "logo.png", paid_stamp: bool = False) -> bytes:
     """
     Generate a professional PDF for a single bill.
@@ -106,6 +111,8 @@ def generate_bill_pdf_bytes(bill: dict, logo_path: str = "logo.png", paid_stamp:
         ("Fixed Charge", bill.get("fixed_charge", 0.0)),
         ("GST (18%)", bill.get("gst", 0.0)),
     ]
+    if bill.get("surcharge"):
+        charges.append(("Late Payment Surcharge", bill["surcharge"]))
     y_row = table_top - row_h
     c.setFont("Helvetica", 10)
     for desc, amt in charges:
@@ -158,3 +165,54 @@ def generate_bill_pdf_bytes(bill: dict, logo_path: str = "logo.png", paid_stamp:
     pdf_bytes = buffer.getvalue()
     buffer.close()
     return pdf_bytes
+
+
+# -------- Report helpers ----------
+def page_frame(df: pd.DataFrame, page: int, page_size: int) -> pd.DataFrame:
+    """Return only the rows for a 1-based page, so the grid serializes one window."""
+    start = max(page - 1, 0) * page_size
+    return df.iloc[start:start + page_size]
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling: keeps first/last points and,
+    per bucket, the point forming the largest triangle with its neighbours.
+    x must be numeric and sorted. Returns the selected indices.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average of the next bucket (or the last point) as the third vertex
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+def revenue_series(created_at: pd.Series, totals: pd.Series, max_points: int = CHART_MAX_POINTS) -> pd.Series:
+    """
+    Revenue over time for charting. Buckets by day, week or month, whichever
+    is the finest that fits in max_points, then applies LTTB if still too long.
+    """
+    span_days = (created_at.max() - created_at.min()).days + 1
+    if span_days <= max_points:
+        freq = "D"
+    elif span_days / 7 <= max_points:
+        freq = "W"
+    else:
+        freq = "MS"
+    series = totals.groupby(created_at.dt.to_period(freq[0]).dt.start_time).sum().sort_index()
+    series.index.name = {"D": "day", "W": "week", "MS": "month"}[freq]
+    if len(series) > max_points:
+        keep = lttb(series.index.asi8, series.to_numpy(), max_points)
+        series = series.iloc[keep]
+    return series